@@ -1,16 +1,41 @@
 from machine import RTC, Pin
-from urequests import get
 from math import floor
-from config import config
-from utime import localtime, gmtime, mktime
+from config import JSON, settings
+from utime import localtime, gmtime, time, ticks_ms, ticks_diff
+from asyncio import sleep, sleep_ms, create_task, wait_for, Event, TimeoutError
+from struct import unpack
 from ds1302 import DS1302
 
 # DAY_IN_SECONDS = 86400
 # DAY_OFFSET = 4
 # DAYS_IN_WEEK = 7
 
+NTP_DELTA = 2208988800
+SLEW_INTERVAL = 10
+MAX_DRIFT_PPM = 500
+RESYNC_SETTINGS = ("timezone_offset", "ntp_server", "ntp_port", "ntp_interval")
+
 rtc = DS1302(Pin(28), Pin(26), Pin(20))
+drift = JSON("/clock.json", default={"drift_ppm": None, "offsets": []})
 is_synced = False
+listeners = []
+last_sync = 0
+pending = 0
+drift_applied = 0
+drift_error = 0
+resync = Event()
+
+def subscribe(callback):
+    listeners.append(callback)
+
+def notify():
+    for callback in listeners:
+        callback()
+
+def settings_changed(key=None):
+    if key is None or key in RESYNC_SETTINGS: resync.set()
+
+settings.subscribe(settings_changed)
 
 def get_time():
     year, month, day, hour, minute, second, _, _ = localtime()
@@ -20,7 +45,7 @@ def get_date():
     return get_time().split()[0]
 
 def sync_from_unixtime(unixtime, weekday=None):
-    tz_unixtime = unixtime + config.get("timezone_offset") + config.get("time_fetch_offset")
+    tz_unixtime = unixtime + settings.timezone_offset
     
     if not weekday:
         weekday = (floor(tz_unixtime / 86400) + 4) % 7
@@ -31,39 +56,136 @@ def sync_from_unixtime(unixtime, weekday=None):
     global is_synced
     is_synced = True
 
-def get_time_from_worldtimeapi():
-    from log import log
-    
-    res = get(url="http://worldtimeapi.org/api/timezone/Asia/Kolkata")
-    data = res.json()
+def read_ntp_timestamp(data, offset):
+    seconds, fraction = unpack("!II", data[offset:offset + 8])
+    return seconds, (fraction * 1000) >> 32
+
+async def get_time_from_ntp(host, port=123, timeout_ms=2000):
+    from socket import socket, getaddrinfo, AF_INET, SOCK_DGRAM
+
+    address = getaddrinfo(host, port)[0][-1]
+    query = bytearray(48)
+    query[0] = 0x1B
+    sock = socket(AF_INET, SOCK_DGRAM)
     try:
-        return data.get("unixtime"), data.get("day_of_week")
-    except Exception as err:
-        log(err)
-        res.close()
+        sock.setblocking(False)
+        sent = ticks_ms()
+        sock.sendto(query, address)
+        while True:
+            try:
+                data = sock.recv(48)
+                break
+            except OSError:
+                if ticks_diff(ticks_ms(), sent) > timeout_ms: raise
+                await sleep_ms(10)
+        received = ticks_ms()
+    finally:
+        sock.close()
+
+    if len(data) < 48 or data[0] & 0x07 != 4 or not 0 < data[1] < 16:
+        raise ValueError("Invalid NTP response")
+    receive_seconds, receive_ms = read_ntp_timestamp(data, 32)
+    transmit_seconds, transmit_ms = read_ntp_timestamp(data, 40)
+    server_ms = (transmit_seconds - receive_seconds) * 1000 + transmit_ms - receive_ms
+    delay_ms = max(0, ticks_diff(received, sent) - server_ms)
+    now_ms = transmit_ms + delay_ms // 2
+    return transmit_seconds - NTP_DELTA + now_ms // 1000, now_ms % 1000, received
+
+async def sync_from_ntp():
+    unixtime, unixtime_ms, received = await get_time_from_ntp(settings.ntp_server, settings.ntp_port)
+    elapsed_ms = ticks_diff(ticks_ms(), received) + unixtime_ms
+    await sleep_ms(1000 - elapsed_ms % 1000)
+    unixtime += elapsed_ms // 1000 + 1
+    correct(unixtime)
+
+def correct(unixtime):
+    global last_sync, pending, drift_applied
+
+    offset = unixtime + settings.timezone_offset - time()
+    drift_ppm = drift.get("drift_ppm")
+    if last_sync and unixtime - last_sync >= 3600:
+        natural_drift = pending - drift_applied - offset
+        rate = natural_drift * 1_000_000 / (unixtime - last_sync)
+        if abs(rate) <= MAX_DRIFT_PPM:
+            drift_ppm = rate if drift_ppm is None else drift_ppm * 0.75 + rate * 0.25
+
+    with drift.batch():
+        drift.set("drift_ppm", drift_ppm)
+        drift.set("offsets", (drift.get("offsets") + [[unixtime, offset]])[-8:])
+    last_sync = unixtime
+    drift_applied = 0
+
+    if abs(offset) > settings.max_slew:
+        pending = 0
+        sync_from_unixtime(unixtime)
+        set_rtc()
+        notify()
+    else:
+        pending = offset
+
+async def next_second():
+    now = time()
+    while time() == now:
+        await sleep_ms(5)
+
+def adjust(seconds):
+    sync_from_unixtime(time() - settings.timezone_offset + seconds)
+    set_rtc()
+    notify()
+
+async def slew():
+    global pending, drift_applied, drift_error
+
+    while True:
+        await sleep(SLEW_INTERVAL)
+        step = 0
+        if pending != 0:
+            step = 1 if pending > 0 else -1
+            pending -= step
+        drift_error -= (drift.get("drift_ppm") or 0) * SLEW_INTERVAL / 1_000_000
+        if abs(drift_error) >= 1:
+            drift_step = 1 if drift_error > 0 else -1
+            drift_error -= drift_step
+            drift_applied += drift_step
+            step += drift_step
+        if step != 0:
+            await next_second()
+            adjust(step)
+
+def get_drift():
+    return {
+        "drift_ppm": drift.get("drift_ppm"),
+        "offsets": drift.get("offsets"),
+        "pending": pending,
+        "last_sync": last_sync,
+        }
 
 def set_rtc(date_time = None):
     if not date_time: date_time = localtime()
     rtc.date_time([date_time[0], date_time[1], date_time[2], (date_time[-2] + 1) % 8, date_time[3], date_time[4], date_time[5]])
-    rtc.start()
     
 def sync_with_rtc():
     pico_rtc = RTC()
     pico_rtc.datetime(rtc.date_time() + [0])
 
-    
 def sync_time():
-    from utils import try_till_success
-    
     global is_synced
     sync_with_rtc()
-    result = try_till_success(get_time_from_worldtimeapi, max_try=10, should_reset=False)
-    if not result:
-        is_synced = True
-        return
-    if result[0] - mktime(gmtime()) < 10:
-        is_synced = True
-        return
-    if not is_synced:
-        sync_from_unixtime(result[0], result[1])
-        set_rtc()
\ No newline at end of file
+    is_synced = True
+
+async def run():
+    from log import log, ERROR
+
+    create_task(slew())
+    while True:
+        resync.clear()
+        try:
+            await sync_from_ntp()
+            delay = settings.ntp_interval
+        except Exception as err:
+            log(err, function_name = "clock.run", level = ERROR)
+            delay = 60
+        try:
+            await wait_for(resync.wait(), delay)
+        except TimeoutError:
+            pass
\ No newline at end of file
@@ -1,24 +1,205 @@
 import json
+from os import rename
+from random import getrandbits
+from error import InvalidPatch, StoreChanged
+
+BOOT_ID = getrandbits(32)
+CHUNK_SIZE = 256
+CACHE_LIMIT = 2048
+
+def iterencode(value):
+    if type(value) == dict:
+        yield "{"
+        separator = ""
+        for key in value:
+            yield separator
+            yield json.dumps(str(key))
+            yield ": "
+            yield from iterencode(value[key])
+            separator = ", "
+        yield "}"
+    elif type(value) in (list, tuple):
+        yield "["
+        separator = ""
+        for item in value:
+            yield separator
+            yield from iterencode(item)
+            separator = ", "
+        yield "]"
+    else:
+        yield json.dumps(value)
+
+def iterchunks(value, chunk_size=CHUNK_SIZE):
+    chunk = []
+    size = 0
+    for piece in iterencode(value):
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk: yield "".join(chunk).encode()
+
+def parse_pointer(pointer):
+    if type(pointer) != str or pointer and pointer[0] != "/":
+        raise InvalidPatch(f"Invalid path '{pointer}'")
+    return [i.replace("~1", "/").replace("~0", "~") for i in pointer.split("/")[1:]]
+
+def list_index(container, token, is_insert=False):
+    if is_insert and token == "-": return len(container)
+    if not token.isdigit() or len(token) > 1 and token[0] == "0":
+        raise InvalidPatch(f"Invalid index '{token}'")
+    idx = int(token)
+    if idx > len(container) or idx == len(container) and not is_insert:
+        raise InvalidPatch(f"Index '{token}' out of range")
+    return idx
+
+def resolve(document, tokens):
+    if not tokens: raise InvalidPatch("Can't change the document root")
+    for token in tokens[:-1]:
+        if type(document) == dict and token in document:
+            document = document[token]
+        elif type(document) == list:
+            document = document[list_index(document, token)]
+        else:
+            raise InvalidPatch(f"Path '{token}' doesn't exist")
+    if type(document) not in (dict, list): raise InvalidPatch(f"Path '{tokens[-1]}' doesn't exist")
+    return document, tokens[-1]
+
+def get_pointer(document, tokens):
+    if not tokens: return document
+    parent, token = resolve(document, tokens)
+    if type(parent) == list: return parent[list_index(parent, token)]
+    if token not in parent: raise InvalidPatch(f"Path '{token}' doesn't exist")
+    return parent[token]
+
+def add_pointer(document, tokens, value):
+    parent, token = resolve(document, tokens)
+    if type(parent) == list: parent.insert(list_index(parent, token, True), value)
+    else: parent[token] = value
+
+def remove_pointer(document, tokens):
+    parent, token = resolve(document, tokens)
+    if type(parent) == list: return parent.pop(list_index(parent, token))
+    if token not in parent: raise InvalidPatch(f"Path '{token}' doesn't exist")
+    return parent.pop(token)
+
+def apply_patch(document, operations):
+    if type(operations) != list: raise InvalidPatch("Patch must be a list of operations")
+    touched = set()
+    for operation in operations:
+        if type(operation) != dict: raise InvalidPatch("Operation must be an object")
+        op = operation.get("op")
+        path = parse_pointer(operation.get("path"))
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise InvalidPatch(f"Operation '{op}' needs a value")
+        if op == "test":
+            if get_pointer(document, path) != operation["value"]:
+                raise InvalidPatch(f"Test failed at '{operation['path']}'")
+            continue
+        if op == "add":
+            add_pointer(document, path, operation["value"])
+        elif op == "remove":
+            remove_pointer(document, path)
+        elif op == "replace":
+            remove_pointer(document, path)
+            add_pointer(document, path, operation["value"])
+        elif op in ("move", "copy"):
+            source = parse_pointer(operation.get("from"))
+            if op == "move":
+                if path[:len(source)] == source and path != source:
+                    raise InvalidPatch("Can't move a value into itself")
+                value = remove_pointer(document, source)
+            else:
+                value = json.loads(json.dumps(get_pointer(document, source)))
+            add_pointer(document, path, value)
+            touched.add(source[0] if source else "")
+        else:
+            raise InvalidPatch(f"Unknown operation '{op}'")
+        touched.add(path[0])
+    return touched
 
 class JSON:
     json_data = {}
+    versions = {}
+    revisions = {}
+    listeners = {}
+    batches = {}
+    serialized = {}
 
-    def __init__(self, file = "/config.json"):
+    def __init__(self, file = "/config.json", default = None):
         self.file = file
 
         if file in JSON.json_data:
             self.json = JSON.json_data[file]
             return
 
+        try:
+            data = self.read()
+        except OSError:
+            if default is None: raise
+            data = default
+        self.json = data
+        JSON.json_data[file] = data
+        JSON.versions[file] = 0
+        JSON.revisions[file] = 0
+        JSON.listeners[file] = []
+        JSON.batches[file] = [0, False, 0]
+
+    @property
+    def version(self):
+        return JSON.versions[self.file]
+
+    @property
+    def etag(self):
+        return f'"{BOOT_ID:08x}-{JSON.revisions[self.file]}"'
+
+    def stream(self):
+        version = self.version
+        cached = JSON.serialized.get(self.file)
+        if cached is not None and cached[0] == version:
+            yield cached[1]
+            return
+        parts = []
+        size = 0
+        for chunk in iterchunks(self.json):
+            size += len(chunk)
+            if size > CACHE_LIMIT: parts = None
+            elif parts is not None: parts.append(chunk)
+            yield chunk
+            if self.version != version: raise StoreChanged(self.file)
+        if parts is not None:
+            JSON.serialized[self.file] = (version, b"".join(parts))
+
+    def subscribe(self, callback):
+        JSON.listeners[self.file].append(callback)
+
+    def changed(self, key=None):
+        JSON.versions[self.file] += 1
+        JSON.revisions[self.file] = JSON.versions[self.file]
+        JSON.serialized.pop(self.file, None)
+        for callback in JSON.listeners[self.file]:
+            callback(key)
+
+    def read(self):
+        temp_file = self.file + ".tmp"
+        try:
+            with open(temp_file, "r") as f:
+                data = json.load(f)
+            rename(temp_file, self.file)
+            return data
+        except (OSError, ValueError):
+            pass
         with open(self.file, "r") as f:
-            data = json.load(f)
-            self.json = data
-            JSON.json_data[file] = data
+            return json.load(f)
 
     def save(self):
+        temp_file = self.file + ".tmp"
         try:
-            with open(self.file, "w") as f:
+            with open(temp_file, "w") as f:
                 json.dump(self.json, f)
+            rename(temp_file, self.file)
             return True
         except:
             return False
@@ -26,21 +207,109 @@ class JSON:
     def load(self):
         return self.json
 
+    def reload(self):
+        data = self.read()
+        self.json.clear()
+        self.json.update(data)
+        self.changed()
+
+    def batch(self):
+        return self
+
+    def __enter__(self):
+        batch = JSON.batches[self.file]
+        if batch[0] == 0: batch[2] = JSON.revisions[self.file]
+        batch[0] += 1
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        batch = JSON.batches[self.file]
+        batch[0] -= 1
+        if batch[0] > 0: return
+        is_dirty = batch[1]
+        batch[1] = False
+        if exc_type is not None:
+            self.reload()
+            JSON.revisions[self.file] = batch[2]
+        elif is_dirty:
+            self.save()
+
+    def commit(self):
+        batch = JSON.batches[self.file]
+        if batch[0] > 0:
+            batch[1] = True
+            return True
+        return self.save()
+
     def set(self, key, value):
         self.json[key] = value
-        if self.save():
+        self.changed(key)
+        if self.commit():
             return value
     
     def get(self, key):
         return self.json.get(key)
 
+    def patch(self, operations):
+        with self.batch():
+            touched = apply_patch(self.json, operations)
+            for key in touched:
+                self.changed(key)
+            if touched: self.commit()
+        return touched
+
     def remove(self, key):
         try:
             value = self.json.pop(key)
-            if self.save():
+            self.changed(key)
+            if self.commit():
                 return value
         except KeyError:
             pass
 
+class Settings:
+    def __init__(self, store, fields):
+        self.store = store
+        self.fields = fields
+        self.listeners = []
+        for key in fields:
+            self.parse(key)
+        store.subscribe(self.changed)
+
+    def parse(self, key):
+        cast, default = self.fields[key]
+        value = self.store.get(key)
+        try:
+            value = default if value is None else cast(value)
+        except (TypeError, ValueError):
+            value = default
+        setattr(self, key, value)
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def changed(self, key=None):
+        keys = self.fields if key is None else [key] if key in self.fields else []
+        updated = False
+        for i in keys:
+            value = getattr(self, i)
+            self.parse(i)
+            updated = updated or getattr(self, i) != value
+        if not updated: return
+        for callback in self.listeners:
+            callback(key)
+
+SETTINGS = {
+    "gap": (int, 0),
+    "max_wait": (int, 0),
+    "timezone_offset": (int, 0),
+    "max_slew": (int, 30),
+    "ntp_server": (str, "pool.ntp.org"),
+    "ntp_port": (int, 123),
+    "ntp_interval": (int, 21600),
+    "log": (str, "/log.txt"),
+    "log_level": (int, 20),
+    }
 
-config = JSON()
\ No newline at end of file
+config = JSON()
+settings = Settings(config, SETTINGS)
\ No newline at end of file
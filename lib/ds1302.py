@@ -10,6 +10,9 @@ DS1302_REG_YEAR   = (0x8C)
 DS1302_REG_WP     = (0x8E)
 DS1302_REG_CTRL   = (0x90)
 DS1302_REG_RAM    = (0xC0)
+DS1302_REG_CLKBURST = (0xBE)
+DS1302_REG_RAMBURST = (0xFE)
+DS1302_RAM_SIZE   = 31
 
 class DS1302:
     def __init__(self, clk, dio, cs):
@@ -54,6 +57,22 @@ class DS1302:
         self._write_byte(dat)
         self.cs.value(0)
 
+    def _burst_read(self, reg, count):
+        dat = bytearray(count)
+        self.cs.value(1)
+        self._write_byte(reg + 1)
+        for i in range(count):
+            dat[i] = self._read_byte()
+        self.cs.value(0)
+        return dat
+
+    def _burst_write(self, reg, dat):
+        self.cs.value(1)
+        self._write_byte(reg)
+        for d in dat:
+            self._write_byte(d)
+        self.cs.value(0)
+
     def _wr(self, reg, dat):
         self._set_reg(DS1302_REG_WP, 0)
         self._set_reg(reg, dat)
@@ -111,18 +130,32 @@ class DS1302:
 
     def date_time(self, dat=None):
         if dat == None:
-            return [self.year(), self.month(), self.day(), self.weekday(), self.hour(), self.minute(), self.second()]
+            t = self._burst_read(DS1302_REG_CLKBURST, 7)
+            return [self._hex2dec(t[6]) + 2000, self._hex2dec(t[4] & 0x1f), self._hex2dec(t[3] & 0x3f), self._hex2dec(t[5] & 0x07),
+                    self._hex2dec(t[2] & 0x3f), self._hex2dec(t[1] & 0x7f), self._hex2dec(t[0] & 0x7f)]
         else:
-            self.year(dat[0])
-            self.month(dat[1])
-            self.day(dat[2])
-            self.weekday(dat[3])
-            self.hour(dat[4])
-            self.minute(dat[5])
-            self.second(dat[6])
+            self._set_reg(DS1302_REG_WP, 0)
+            self._burst_write(DS1302_REG_CLKBURST, [
+                self._dec2hex(dat[6] % 60),
+                self._dec2hex(dat[5] % 60),
+                self._dec2hex(dat[4] % 24),
+                self._dec2hex(dat[2] % 32),
+                self._dec2hex(dat[1] % 13),
+                self._dec2hex(dat[3] % 8),
+                self._dec2hex(dat[0] % 100),
+                0x80,
+                ])
 
     def ram(self, reg, dat=None):
         if dat == None:
             return self._get_reg(DS1302_REG_RAM + 1 + (reg % 31)*2)
         else:
-            self._wr(DS1302_REG_RAM + (reg % 31)*2, dat)
\ No newline at end of file
+            self._wr(DS1302_REG_RAM + (reg % 31)*2, dat)
+
+    def ram_burst(self, dat=None, count=DS1302_RAM_SIZE):
+        if dat == None:
+            return self._burst_read(DS1302_REG_RAMBURST, min(count, DS1302_RAM_SIZE))
+        else:
+            self._set_reg(DS1302_REG_WP, 0)
+            self._burst_write(DS1302_REG_RAMBURST, dat[:DS1302_RAM_SIZE])
+            self._set_reg(DS1302_REG_WP, 0x80)
\ No newline at end of file
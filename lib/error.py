@@ -5,4 +5,13 @@ class NoAccessPointFound(Exception):
   pass
 
 class WrongPassword(Exception):
+  pass
+
+class InvalidSchedule(Exception):
+  pass
+
+class InvalidPatch(Exception):
+  pass
+
+class StoreChanged(Exception):
   pass
\ No newline at end of file
@@ -0,0 +1,133 @@
+REFERENCE_KINDS = ("weekly", "monthly", "once", "skip")
+
+class ScheduleIndex:
+    def __init__(self, store):
+        self.store = store
+        self.refs = {}
+        self.is_stale = True
+        self.is_updating = False
+        store.subscribe(self.changed)
+
+    def changed(self, key=None):
+        if not self.is_updating and (key is None or key in REFERENCE_KINDS):
+            self.is_stale = True
+
+    def refresh(self):
+        if not self.is_stale: return
+        self.refs = {}
+        weekly_schedules = self.store.get("weekly")
+        for day in range(len(weekly_schedules)):
+            for name in weekly_schedules[day]:
+                self.add(name, "weekly", day)
+        for kind in REFERENCE_KINDS[1:]:
+            references = self.store.get(kind)
+            for key in references:
+                for name in references[key]:
+                    self.add(name, kind, key)
+        self.is_stale = False
+
+    def add(self, name, kind, key):
+        refs = self.refs.get(name)
+        if refs is None:
+            refs = self.refs[name] = {}
+        keys = refs.get(kind)
+        if keys is None:
+            keys = refs[kind] = set()
+        keys.add(key)
+
+    def discard(self, name, kind, key):
+        refs = self.refs.get(name)
+        if refs is None or kind not in refs: return
+        refs[kind].discard(key)
+        if not refs[kind]: refs.pop(kind)
+        if not refs: self.refs.pop(name)
+
+    def names(self):
+        self.refresh()
+        return list(self.refs.keys())
+
+    def lookup(self, name, kind):
+        self.refresh()
+        refs = self.refs.get(name)
+        if refs is None: return ()
+        return refs.get(kind, ())
+
+    def is_scheduled(self, name, weekday, mday, date):
+        self.refresh()
+        refs = self.refs.get(name)
+        if refs is None: return False
+        return weekday in refs.get("weekly", ()) or \
+            mday in refs.get("monthly", ()) or \
+            date in refs.get("once", ())
+
+    def reference_list(self, kind, key, create=False):
+        references = self.store.get(kind)
+        if kind == "weekly": return references[key]
+        if create and key not in references: references[key] = []
+        return references.get(key)
+
+    def save(self, *kinds):
+        self.is_updating = True
+        try:
+            with self.store.batch():
+                for kind in kinds:
+                    self.store.set(kind, self.store.get(kind))
+        finally:
+            self.is_updating = False
+
+    def remove_reference(self, name, kind, key):
+        names = self.reference_list(kind, key)
+        if names is not None and name in names:
+            names.remove(name)
+            if not names and kind != "weekly": self.store.get(kind).pop(key)
+        self.discard(name, kind, key)
+
+    def assign(self, kind, key, names):
+        self.refresh()
+        schedule_list = self.reference_list(kind, key, True)
+        for name in names:
+            if key in self.lookup(name, kind): continue
+            schedule_list.append(name)
+            self.add(name, kind, key)
+        if kind != "weekly" and not schedule_list: self.store.get(kind).pop(key)
+        self.save(kind)
+
+    def unassign(self, kind, key, names):
+        self.refresh()
+        for name in names:
+            self.remove_reference(name, kind, key)
+        self.save(kind)
+
+    def clear(self, kind, key):
+        names = self.reference_list(kind, key)
+        if names: self.unassign(kind, key, list(names))
+
+    def replace(self, kind, key, names):
+        with self.store.batch():
+            self.clear(kind, key)
+            self.assign(kind, key, names)
+
+    def rename_reference(self, name, new_name, kind, key):
+        names = self.reference_list(kind, key)
+        if names is None or name not in names: return
+        if new_name in names:
+            self.remove_reference(name, kind, key)
+            return
+        names[names.index(name)] = new_name
+        self.discard(name, kind, key)
+        self.add(new_name, kind, key)
+
+    def rewrite(self, renamed, kinds=REFERENCE_KINDS):
+        self.refresh()
+        changed = set()
+        for name, new_name in renamed.items():
+            for kind in kinds:
+                for key in list(self.lookup(name, kind)):
+                    if new_name is None: self.remove_reference(name, kind, key)
+                    else: self.rename_reference(name, new_name, kind, key)
+                    changed.add(kind)
+        if changed: self.save(*changed)
+        return changed
+
+    def unassign_all(self, names, kinds=REFERENCE_KINDS):
+        return self.rewrite(dict.fromkeys(names), kinds)
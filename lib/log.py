@@ -1,34 +1,164 @@
-from config import config
-from clock import get_time
-from os import stat
+from config import settings
+from os import stat, statvfs, remove
+from errno import ENOSPC
+from struct import pack, unpack
+from time import localtime, time
+from asyncio import wait_for, Event, TimeoutError
 
-def log(*msg, function_name=""):
-    file_path = config.get("log") or "/log.txt"
-    line = f"[{get_time()}]"
+LOG_MAGIC = b"RLOG"
+LOG_HEADER = "<4sHH"
+LOG_HEADER_SIZE = 8
+LOG_SLOT_SIZE = 128
+LOG_TEXT_SIZE = LOG_SLOT_SIZE - 4
+LOG_SLOTS = 2048
+LOG_SIZE = LOG_HEADER_SIZE + LOG_SLOT_SIZE * LOG_SLOTS
+LOG_FLUSH_INTERVAL = 10
+LOG_FLUSH_LINES = 16
+LOG_BUFFER_LIMIT = 64
+LOG_FREE_RESERVE = 16 * 1024
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+
+log_file = None
+buffer = []
+pending = []
+flush_requested = Event()
+is_running = False
+
+def format_time(unixtime):
+    year, month, day, hour, minute, second, _, _ = localtime(unixtime)
+    return f"{day}/{month}/{year} {hour}:{minute}:{second}"
+
+def create_log(file_path):
+    empty = bytes(LOG_SLOT_SIZE * 32)
+    with open(file_path, "wb") as f:
+        f.write(pack(LOG_HEADER, LOG_MAGIC, 0, 0))
+        for _ in range(LOG_SLOTS // 32):
+            f.write(empty)
+
+def open_log():
+    global log_file
+    file_path = settings.log
+    if log_file == file_path: return file_path
+    try:
+        with open(file_path, "rb") as f:
+            header = f.read(LOG_HEADER_SIZE)
+        if header[:4] == LOG_MAGIC and stat(file_path)[6] == LOG_SIZE:
+            log_file = file_path
+            return file_path
+        remove(file_path)
+    except OSError:
+        pass
+    stats = statvfs("/")
+    if stats[0] * stats[4] < LOG_SIZE + LOG_FREE_RESERVE: raise OSError(ENOSPC)
+    try:
+        create_log(file_path)
+    except OSError:
+        try:
+            remove(file_path)
+        except OSError:
+            pass
+        raise
+    log_file = file_path
+    return file_path
+
+def encode_text(text):
+    data = text.encode()[:LOG_TEXT_SIZE]
+    while True:
+        try:
+            data.decode()
+            return data
+        except UnicodeError:
+            data = data[:-1]
+
+def write_log(records):
+    with open(open_log(), "r+b") as f:
+        _, head, count = unpack(LOG_HEADER, f.read(LOG_HEADER_SIZE))
+        for unixtime, text in records:
+            data = encode_text(text)
+            f.seek(LOG_HEADER_SIZE + head * LOG_SLOT_SIZE)
+            f.write(pack("<I", unixtime) + data + bytes(LOG_TEXT_SIZE - len(data)))
+            head = (head + 1) % LOG_SLOTS
+            count = min(count + 1, LOG_SLOTS)
+        f.seek(0)
+        f.write(pack(LOG_HEADER, LOG_MAGIC, head, count))
+
+def seek_record(f, head, count, index):
+    f.seek(LOG_HEADER_SIZE + (head - count + index) % LOG_SLOTS * LOG_SLOT_SIZE)
+
+def find_since(f, head, count, since):
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        seek_record(f, head, count, mid)
+        if unpack("<I", f.read(4))[0] < since: lo = mid + 1
+        else: hi = mid
+    return lo
+
+def read_log(offset=0, limit=LOG_SLOTS, tail=None, since=None, reverse=False):
+    with open(open_log(), "rb") as f:
+        _, head, count = unpack(LOG_HEADER, f.read(LOG_HEADER_SIZE))
+        start = 0 if since is None else find_since(f, head, count, since)
+        if tail is not None:
+            limit, offset = min(limit, tail), 0
+        if reverse or tail is not None:
+            last = max(start, count - offset)
+            first = max(start, last - limit)
+        else:
+            first = min(count, start + offset)
+            last = min(count, first + limit)
+        r = range(last - 1, first - 1, -1) if reverse else range(first, last)
+        for i in r:
+            seek_record(f, head, count, i)
+            record = f.read(LOG_SLOT_SIZE)
+            yield unpack("<I", record[:4])[0], record[4:].rstrip(b"\0").decode()
+
+def format_record(level, function_name, msg):
+    line = LEVEL_NAMES.get(level, str(level))
     if function_name != "":
-        line += f" ({function_name})"
-    line += ":";
+        line += f" ({function_name}):"
     for i in msg:
-        i = str(i)
         line += f" {i}"
-    print(line)
-    line += "\n"
+    return line
+
+def flush():
+    global buffer, pending
+    if not buffer and not pending: return
+    records, buffer = buffer, []
+    lines, pending = pending, []
+    for unixtime, level, function_name, msg in records:
+        line = format_record(level, function_name, msg)
+        print(f"[{format_time(unixtime)}] {line}")
+        lines.append((unixtime, line))
     try:
-        if stat(file_path)[6] > 5_24_288:
-            line += "File size limit exceeded, overwirting log"
-            raise Exception("File size limit exceeded")
-        with open(file_path, "a") as f:
-            f.write(line)
+        write_log(lines)
     except Exception as err:
-        from gc import collect
-        
-        collect()
-        with open(file_path, "w+") as f:
-            logs = f.readlines()
-            logs.append(line)
-            quater_len = len(logs) // 4
-            r = range(-quater_len, 0, -1)
-            for i in r:
-                f.write(logs[i])
-        
-        collect()
\ No newline at end of file
+        print(f"Couldn't write log: {err}")
+        pending = lines[-LOG_BUFFER_LIMIT:]
+
+def log(*msg, function_name="", level=INFO):
+    if level < settings.log_level: return
+    buffer.append((time(), level, function_name, msg))
+    if level >= ERROR or not is_running:
+        flush()
+    elif len(buffer) >= LOG_FLUSH_LINES:
+        flush_requested.set()
+
+async def run():
+    global is_running
+    is_running = True
+    try:
+        while True:
+            flush_requested.clear()
+            try:
+                await wait_for(flush_requested.wait(), LOG_FLUSH_INTERVAL)
+            except TimeoutError:
+                pass
+            flush()
+    finally:
+        is_running = False
+        flush()
\ No newline at end of file
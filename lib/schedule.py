@@ -1,62 +1,260 @@
-from switch import switch_on, switch_off, timer, repeat_timer
-from config import JSON, config
-from log import log
+from switch import switch_on, stop, ring
+from config import JSON, settings
+from log import log, DEBUG, WARNING, ERROR
 from time import mktime, localtime, time
-from asyncio import sleep
-from clock import is_synced as time_is_synced, get_date
+from array import array
+from asyncio import sleep, sleep_ms, wait_for, Event, TimeoutError
+from clock import get_date
+import clock
+from state import state, STATE_FIELDS
+from error import InvalidSchedule
+from index import ScheduleIndex
 
 schedule = JSON("/schedule.json")
+schedule_changed = Event()
+references = ScheduleIndex(schedule)
+
+def wake(key=None):
+    schedule_changed.set()
+
+schedule.subscribe(wake)
+settings.subscribe(wake)
+clock.subscribe(wake)
+timeline = None
+timeline_key = None
+skip_calendar = None
+skip_calendar_version = None
+mode_table = []
+mode_ids = {}
+compiled_schedules = {}
+
+MODE_ON = 0
+MODE_OFF = 1
+MODE_RING = 2
+
+def migrate_state():
+    if not state.is_valid:
+        with state.batch():
+            for key in STATE_FIELDS:
+                if schedule.get(key) is not None: state.set(key, schedule.get(key))
+    with schedule.batch():
+        for key in STATE_FIELDS:
+            schedule.remove(key)
+
+migrate_state()
 
 @micropython.native
-def convert_to_unix_time(time_string):
-    time = list(map(int, time_string.split(":")))
+def parse_time(time_string):
+    try:
+        time = [int(i) for i in time_string.split(":")]
+    except (AttributeError, ValueError):
+        raise InvalidSchedule(f"Invalid time '{time_string}'")
     if len(time) == 2: time.append(0)
-    tm = (1970, 1, 1, time[0], time[1], time[2], 0, 0)
-    unix_time = mktime(tm)
-    return unix_time
+    if len(time) != 3 or not (0 <= time[0] < 24 and 0 <= time[1] < 60 and 0 <= time[2] < 60):
+        raise InvalidSchedule(f"Invalid time '{time_string}'")
+    return time[0] * 3600 + time[1] * 60 + time[2]
+
+def format_time(seconds):
+    hour, minute, second = seconds // 3600, seconds // 60 % 60, seconds % 60
+    if second: return f"{hour:02d}:{minute:02d}:{second:02d}"
+    return f"{hour:02d}:{minute:02d}"
+
+def parse_number(value, name, minimum=0, is_integer=False):
+    if type(value) not in (int, float) or value < minimum or is_integer and int(value) != value:
+        raise InvalidSchedule(f"Invalid {name} '{value}'")
+    return int(value) if is_integer else value
 
 @micropython.native
-def get_mode_string(mode):
-    duration = mode["duration"]
+def decode_mode(mode):
     if mode["type"] == "single":
-        return f"timer/{duration}"
+        return (MODE_RING, 1, float(mode["duration"]), 0.0)
     elif mode["type"] == "repeat":
-        ring_count = mode.get("ringCount", 0)
-        gap = mode.get("gap", 0)
-        return f"repeat/{ring_count}/{duration}/{gap}"
+        return (MODE_RING, int(mode.get("ringCount", 0)), float(mode["duration"]), float(mode.get("gap", 0)))
     elif mode["type"] == "on":
-        return "on"
+        return (MODE_ON, 0, 0.0, 0.0)
     elif mode["type"] == "off":
-        return "off"
-    
+        return (MODE_OFF, 0, 0.0, 0.0)
+    raise ValueError("Unknown mode type")
+
 @micropython.native
-def expand_schedule(schedules):
-    if type(schedules[0]) != type(dict()): return schedules
-    expanded_schedule = {}
-    for sched in schedules:
-        start_time = convert_to_unix_time(sched["start"])
+def parse_mode(params):
+    params = params.split("/", 3)
+    mode = params[0].lower()
+    if mode == "on":
+        return (MODE_ON, 0, 0.0, 0.0)
+    elif mode == "off":
+        return (MODE_OFF, 0, 0.0, 0.0)
+    elif mode == "timer":
+        return (MODE_RING, 1, float(params[1]), 0.0)
+    elif mode == "repeat":
+        return (MODE_RING, int(params[1]), float(params[2]), float(params[3]))
+    raise ValueError("Unknown mode")
+
+def normalize_mode(mode):
+    if type(mode) != dict or mode.get("type") not in ("single", "repeat", "on", "off"):
+        raise InvalidSchedule(f"Invalid mode '{mode}'")
+    mode = dict(mode)
+    if mode["type"] in ("single", "repeat"):
+        mode["duration"] = parse_number(mode.get("duration"), "duration", 0.1)
+    if mode["type"] == "repeat":
+        mode["ringCount"] = parse_number(mode.get("ringCount"), "ringCount", 1, True)
+        mode["gap"] = parse_number(mode.get("gap", 0), "gap")
+    return mode
+
+def normalize_wild_schedule(definitions):
+    normalized = []
+    previous = None
+    for i, definition in enumerate(definitions):
+        if type(definition) not in (list, tuple) or len(definition) != 2:
+            raise InvalidSchedule(f"Invalid wild schedule entry '{definition}'")
+        offset, mode = definition
+        if i == 0 and offset != "*" and type(offset) != int or \
+           i > 0 and type(offset) != int and not (type(offset) == str and offset[:1] == "+" and offset[1:].isdigit()):
+            raise InvalidSchedule(f"Invalid wild schedule offset '{offset}'")
+        if i == 0:
+            if type(offset) == int: previous = offset
+            gap = None
+        elif type(offset) == str:
+            gap = int(offset[1:])
+            if previous is not None: previous += gap
+        elif previous is not None:
+            gap = offset - previous
+            previous = offset
+        else:
+            gap = offset
+        if gap is not None and gap < 0:
+            raise InvalidSchedule(f"Invalid wild schedule offset '{offset}'")
+        try:
+            parse_mode(mode)
+        except (AttributeError, IndexError, ValueError):
+            raise InvalidSchedule(f"Invalid mode '{mode}'")
+        normalized.append(["*" if gap is None else f"+{gap}", mode])
+    return normalized
+
+def normalize_schedule(name, definitions):
+    try:
+        if type(definitions) != list or not definitions:
+            raise InvalidSchedule("Schedule must be a non-empty list")
+        if type(definitions[0]) != dict:
+            return normalize_wild_schedule(definitions)
+        normalized = []
+        for definition in definitions:
+            if type(definition) != dict or definition.get("type") not in ("single", "session"):
+                raise InvalidSchedule(f"Invalid schedule type '{definition}'")
+            definition = dict(definition)
+            definition["start"] = format_time(parse_time(definition.get("start")))
+            definition["mode"] = normalize_mode(definition.get("mode"))
+            if definition["type"] == "session":
+                definition["end"] = format_time(parse_time(definition.get("end")))
+                definition["interval"] = parse_number(definition.get("interval"), "interval", 1 / 60)
+                definition["includeEndTime"] = bool(definition.get("includeEndTime", True))
+            normalized.append(definition)
+        return normalized
+    except InvalidSchedule as err:
+        raise InvalidSchedule(f"{name}: {err}")
+
+def compile_wild_schedule(definitions):
+    offsets = array("l")
+    modes = []
+    offset = 0
+    for gap, mode in definitions:
+        if gap != "*": offset += int(gap[1:])
+        offsets.append(offset)
+        modes.append(parse_mode(mode))
+    return (offsets, modes)
+
+def compile_schedule(definitions):
+    compiled = []
+    if type(definitions[0]) != dict:
+        return compile_wild_schedule(definitions)
+    for sched in definitions:
+        start_time = parse_time(sched["start"])
+        mode = decode_mode(sched["mode"])
         if sched["type"] == "session":
-            end_time = convert_to_unix_time(sched.get("end", ""))
-            include_end_time = sched.get("includeEndTime", True)
-            interval_in_seconds = sched.get("interval", 0) * 60
-            mode = get_mode_string(sched["mode"])
-            i = start_time
-            while i < end_time:
-                expanded_schedule[int(i)] = mode
-                i += interval_in_seconds
-            if include_end_time:
-                expanded_schedule[end_time] = mode
+            end_time = parse_time(sched["end"])
+            interval_in_seconds = int(sched["interval"] * 60)
+            compiled.append((start_time, end_time, interval_in_seconds, sched["includeEndTime"], mode))
         else:
-            mode = get_mode_string(sched["mode"])
-            expanded_schedule[start_time] = mode
-    return list(expanded_schedule.items())
+            compiled.append((start_time, mode))
+    return compiled
+
+def get_compiled_schedule(name, definitions):
+    cached = compiled_schedules.get(name)
+    if cached is not None and cached[0] is definitions: return cached[1]
+    try:
+        compiled = compile_schedule(normalize_schedule(name, definitions))
+    except InvalidSchedule as err:
+        log(err, function_name = "schedule.compile", level = WARNING)
+        compiled = []
+    compiled_schedules[name] = (definitions, compiled)
+    return compiled
+
+def intern_mode(mode):
+    idx = mode_ids.get(mode)
+    if idx is None:
+        idx = len(mode_table)
+        mode_table.append(mode)
+        mode_ids[mode] = idx
+    return idx
+
+@micropython.native
+def session_next(session, seconds):
+    start, end, step, include_end, _ = session
+    if seconds <= start and start < end: return start
+    if step > 0 and start < end:
+        ring = start + (seconds - start + step - 1) // step * step
+        if ring < end: return ring
+    if include_end and seconds <= end: return end
 
 @micropython.native
-def is_wild_schedule(schedule_name, strict=True):
-    wild_schedule = schedule.get("schedules").get(schedule_name)
-    if len(wild_schedule) == 0 or len(wild_schedule[0]) != 2: return False
-    wild_schedules = schedule.get("wild_schedules")
-    return wild_schedule[0][0] == "*" or not strict and schedule_name in wild_schedules
+def session_last(session):
+    start, end, step, include_end, _ = session
+    if include_end: return end
+    if start >= end: return None
+    if step <= 0: return start
+    return start + (end - 1 - start) // step * step
+
+@micropython.native
+def expand_schedule(compiled, singles, sessions):
+    for item in compiled:
+        if len(item) == 2:
+            singles[item[0]] = intern_mode(item[1])
+            continue
+        session = (item[0], item[1], item[2], item[3], intern_mode(item[4]))
+        for unixtime in [i for i in singles if session_next(session, i) == i]:
+            singles.pop(unixtime)
+        sessions.append(session)
+
+@micropython.native
+def expand_wild_schedule(compiled, trigger, singles):
+    if not compiled: return
+    offsets, modes = compiled
+    for i in range(len(offsets)):
+        if trigger + offsets[i] < 0: continue
+        singles[trigger + offsets[i]] = intern_mode(modes[i])
+
+@micropython.native
+def is_wild_schedule(schedule_name):
+    definitions = schedule.get("schedules").get(schedule_name)
+    return bool(definitions) and type(definitions[0]) != dict
+
+def migrate_wild_schedules():
+    schedules = schedule.get("schedules") or {}
+    legacy = [i for i in schedules if is_wild_schedule(i) and schedules[i][0][0] != "*"]
+    if not legacy: return
+    triggers = schedule.get("triggers") or {}
+    with schedule.batch():
+        for name in legacy:
+            trigger = schedules[name][0][0]
+            try:
+                schedules[name] = normalize_wild_schedule(schedules[name])
+            except InvalidSchedule:
+                continue
+            if type(trigger) == int: triggers[name] = trigger
+        schedule.set("schedules", schedules)
+        schedule.set("triggers", triggers)
+
+migrate_wild_schedules()
 
 @micropython.native
 def all_schedule_exists(*schedule_list):
@@ -66,32 +264,54 @@ def all_schedule_exists(*schedule_list):
     return True
 
 @micropython.native
-def remove_non_existent_schedules():
-    weekly_schedules = schedule.get("weekly")
-    monthly_schedules = schedule.get("monthly")
-    once = schedule.get("once")
-    wild_schedules = schedule.get("wild_schedules")
-    skip = schedule.get("skip")
-    active = schedule.get("active")
-    schedules = schedule.get("schedules")
+def rename_names(names, renamed, schedules):
+    result = []
+    seen = set()
+    for name in names:
+        name = renamed.get(name, name)
+        if name is None or name in seen or name not in schedules: continue
+        seen.add(name)
+        result.append(name)
+    return result
 
-    for i in range(len(weekly_schedules)):
-        weekly_schedules[i] = [j for j in weekly_schedules[i] if j in schedules]
+def enforce_integrity(renamed=None):
+    renamed = dict(renamed or {})
+    schedules = schedule.get("schedules")
+    for name in references.names():
+        if name not in renamed and name not in schedules: renamed[name] = None
+    for name in list(renamed):
+        if renamed[name] is not None and renamed[name] not in schedules: renamed[name] = None
 
-    for key in list(once.keys()):
-        once[key] = [i for i in once[key] if i in schedules]
-        if not once[key]: once.pop(key)
+    with schedule.batch():
+        changed = references.rewrite(renamed)
+        triggers = schedule.get("triggers") or {}
+        updated = {}
+        for name, trigger in triggers.items():
+            name = renamed.get(name, name)
+            if name is not None and name in schedules: updated[name] = trigger
+        if updated != triggers:
+            schedule.set("triggers", updated)
+            changed.add("triggers")
 
-    for key in list(skip.keys()):
-        skip[key] = [i for i in skip[key] if i in schedules]
-        if not skip[key]: skip.pop(key)
-  
-    for key in list(monthly_schedules.keys()):
-        monthly_schedules[key] = [i for i in monthly_schedules[key] if i in schedules]
-        if not monthly_schedules[key]: monthly_schedules.pop(key)
+        for key in ("active", "wild_schedules"):
+            names = schedule.get(key)
+            updated = rename_names(names, renamed, schedules)
+            if updated != names:
+                schedule.set(key, updated)
+                changed.add(key)
 
-    schedule.set("active", [i for i in active if i in schedules])
-    schedule.set("wild_schedules", [i for i in wild_schedules if i in schedules])
+        ranges = schedule.get("skip_ranges") or []
+        updated = []
+        for skip_range in ranges:
+            names = rename_names(skip_range["schedules"], renamed, schedules)
+            if not names: continue
+            skip_range = skip_range.copy()
+            skip_range["schedules"] = names
+            updated.append(skip_range)
+        if updated != ranges:
+            schedule.set("skip_ranges", updated)
+            changed.add("skip_ranges")
+    return changed
     
 @micropython.native
 def remove_date_from_unixtime(unixtime):
@@ -101,157 +321,293 @@ def remove_date_from_unixtime(unixtime):
     return unixtime
 
 @micropython.native
+def parse_date(date_string, year=None):
+    try:
+        date = [int(i) for i in date_string.split("/")]
+    except (AttributeError, ValueError):
+        raise InvalidSchedule(f"Invalid date '{date_string}'")
+    if len(date) == 2 and year is not None: date.append(year)
+    if len(date) != 3: raise InvalidSchedule(f"Invalid date '{date_string}'")
+    day, month, year = date
+    seconds = mktime((year, month, day, 0, 0, 0, 0, 0))
+    if localtime(seconds)[:3] != (year, month, day):
+        raise InvalidSchedule(f"Invalid date '{date_string}'")
+    return seconds // 86400
+
+def format_date(day_number):
+    year, month, day = localtime(day_number * 86400)[:3]
+    return f"{day}/{month}/{year}"
+
+def normalize_skip_range(skip_range):
+    if type(skip_range) != dict: raise InvalidSchedule("Skip range must be an object")
+    year = localtime()[0]
+    start = parse_date(skip_range.get("from"), year)
+    end = skip_range.get("to") or skip_range.get("from")
+    year = localtime(start * 86400)[0]
+    if type(end) == str and end.count("/") == 1 and parse_date(end, year) < start: year += 1
+    end = parse_date(end, year)
+    if end < start: raise InvalidSchedule("Skip range ends before it starts")
+    names = skip_range.get("schedules")
+    if type(names) != list or not all(type(i) == str for i in names):
+        raise InvalidSchedule("Skip range needs a list of schedules")
+    return {
+        "from": format_date(start),
+        "to": format_date(end),
+        "schedules": list(dict.fromkeys(names)),
+        }
+
+def merge_skip_ranges(ranges, updates):
+    # ranges are keyed by their span; an empty schedule list removes the span
+    merged = list(ranges)
+    for update in updates:
+        span = (update["from"], update["to"])
+        merged = [i for i in merged if (i["from"], i["to"]) != span]
+        if update["schedules"]: merged.append(update)
+    return merged
+
+def get_skip_calendar():
+    global skip_calendar, skip_calendar_version
+    if skip_calendar_version != schedule.version:
+        ranges = sorted((parse_date(i["from"]), parse_date(i["to"]), i["schedules"]) for i in schedule.get("skip_ranges") or [])
+        skip_calendar = (
+            array("l", [i[0] for i in ranges]),
+            array("l", [i[1] for i in ranges]),
+            [i[2] for i in ranges],
+            )
+        skip_calendar_version = schedule.version
+    return skip_calendar
+
+def skipped_on(day_number):
+    starts, ends, names = get_skip_calendar()
+    skipped = set()
+    for i in range(bisect_left(starts, day_number + 1, 0, len(starts))):
+        if ends[i] >= day_number: skipped.update(names[i])
+    return skipped
+
+def is_past(date, day_number):
+    try:
+        return parse_date(date) < day_number
+    except InvalidSchedule:
+        return False
+
+def compact_calendar():
+    today = parse_date(get_date())
+    stale = [(kind, key) for kind in ("once", "skip") for key in schedule.get(kind) if is_past(key, today)]
+    ranges = schedule.get("skip_ranges") or []
+    current = [i for i in ranges if not is_past(i["to"], today)]
+    if not stale and len(current) == len(ranges): return
+    with schedule.batch():
+        for kind, key in stale:
+            references.clear(kind, key)
+        if len(current) != len(ranges): schedule.set("skip_ranges", current)
+    log("compacted", len(stale), "dates and", len(ranges) - len(current), "skip ranges", level = DEBUG)
+
 def get_active_schedule():
+    global timeline, timeline_key
+    today = localtime()[:3]
+    if timeline_key is None or timeline_key[0] != today: compact_calendar()
+    key = (today, schedule.version)
+    if key != timeline_key:
+        timeline = build_active_schedule()
+        timeline_key = key
+    return timeline
+
+@micropython.native
+def build_active_schedule():
     active_schedule_names = schedule.get("active")
     schedules = schedule.get("schedules")
-    weekly_schedules = schedule.get("weekly")
-    monthly_schedules = schedule.get("monthly")
-    once = schedule.get("once").get(get_date()) or []
-    skip = schedule.get("skip").get(get_date()) or {}
-    active_schedule = {}
-    _, _, mday, _, _, _, weekday, _ = localtime()
+    triggers = schedule.get("triggers") or {}
+    date = get_date()
+    skipped = skipped_on(parse_date(date))
+    singles = {}
+    sessions = []
+    mode_table.clear()
+    mode_ids.clear()
+    for name in [i for i in compiled_schedules if i not in schedules]:
+        compiled_schedules.pop(name)
+    now = time()
+    _, _, mday, hour, minute, second, weekday, _ = localtime(now)
+    midnight = now - hour * 3600 - minute * 60 - second
     for i in active_schedule_names:
-        if i not in schedules or i in skip: continue
-        if i in weekly_schedules[weekday] or \
-           i in (monthly_schedules.get(str(mday)) or []) or \
-           i in once:
+        if i not in schedules or i in skipped or date in references.lookup(i, "skip"): continue
+        if references.is_scheduled(i, weekday, str(mday), date):
+            compiled = get_compiled_schedule(i, schedules.get(i))
             if not is_wild_schedule(i):
-                expanded_schedule = expand_schedule(schedules.get(i))
-                active_schedule.update(expanded_schedule)
-    active_schedule = list(active_schedule.items())
-    return sorted(active_schedule, key=lambda x: x[0])
+                expand_schedule(compiled, singles, sessions)
+            elif i in triggers:
+                expand_wild_schedule(compiled, triggers[i] - midnight, singles)
+    return Timeline(singles, sessions)
 
 @micropython.native
-def get_next_ring_index(running, progress, current_time):
-    start_idx = 0
-    midnight_reset_count = schedule.get("midnight_reset_count")
-    if midnight_reset_count > 0:
-        r = range(1, len(running))
+def bisect_left(values, value, lo, hi):
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] < value: lo = mid + 1
+        else: hi = mid
+    return lo
+
+class Timeline:
+    def __init__(self, singles, sessions):
+        self.sessions = sessions
+        self.times = array("l")
+        self.modes = array("H")
+        self.segments = [0]
+        sessions_last = max([i for i in map(session_last, sessions) if i is not None] or [-1])
+        for unixtime in sorted(i for i in singles if i < 86400):
+            self.times.append(unixtime)
+            self.modes.append(singles[unixtime])
+        self.last = max(self.times[-1] if self.times else -1, sessions_last)
+        for seconds in sorted(i for i in singles if i >= 86400):
+            while len(self.segments) <= seconds // 86400:
+                self.segments.append(len(self.times))
+            self.times.append(seconds % 86400)
+            self.modes.append(singles[seconds])
+            self.last = seconds % 86400
+        self.segments.append(len(self.times))
+
+    def __len__(self):
+        return len(self.times) + len(self.sessions)
+
+    @micropython.native
+    def next_in_segment(self, segment, seconds):
+        lo = self.segments[segment]
+        hi = self.segments[segment + 1]
+        idx = bisect_left(self.times, seconds, lo, hi)
+        ring = (self.times[idx], mode_table[self.modes[idx]]) if idx < hi else None
+        if segment > 0: return ring
+        is_single = ring is not None
+        for session in self.sessions:
+            unixtime = session_next(session, seconds)
+            if unixtime is None: continue
+            if ring is None or unixtime < ring[0] or unixtime == ring[0] and not is_single:
+                ring = (unixtime, mode_table[session[4]])
+                is_single = False
+        return ring
+
+    @micropython.native
+    def next_ring(self, progress, current_time, midnight_reset_count, max_wait):
+        last_segment = len(self.segments) - 2
+        lower = min(current_time, max(current_time - max_wait + 1, progress + 1))
+        r = range(min(midnight_reset_count, last_segment), last_segment + 1)
         for i in r:
-            prev_time = remove_date_from_unixtime(running[i-1][0])
-            next_time = remove_date_from_unixtime(running[i][0])
-            if prev_time > next_time:
-                start_idx = i
-                midnight_reset_count -= 1
-                if midnight_reset_count <= 0: break
-    r = range(start_idx, len(running))
-    for i in r:
-        unixtime = remove_date_from_unixtime(running[i][0])
-        has_rang = progress >= unixtime
-        if current_time <= unixtime or 0 < current_time - unixtime < int(config.get("max_wait")) and not has_rang:
-            return i
-    return -1
+            ring = self.next_in_segment(i, lower)
+            if ring is not None:
+                return ring[0], ring[1], i == last_segment and ring[0] == self.last
+        return None
 
-@micropython.native
-def ring_bell(params):
-    params = params.split("/", 3)
-    mode = params[0].lower()
-    if mode == "on":
+async def ring_bell(mode):
+    mode_type, count, on_seconds, off_seconds = mode
+    if mode_type == MODE_ON:
+        stop()
         switch_on()
-    elif mode == "off":
-        switch_off()
-    elif mode == "timer":
-        on_seconds = float(params[1])
-        timer(on_seconds)
-    elif mode == "repeat":
-        repeat = int(params[1])
-        on_seconds = float(params[2])
-        off_seconds = float(params[3])
-        repeat_timer(repeat, on_seconds, off_seconds)
+    elif mode_type == MODE_OFF:
+        stop()
+    elif mode_type == MODE_RING:
+        return await ring(count, on_seconds, off_seconds)
+    return True
 
 @micropython.native
-def save_progress(running, idx, current_time_with_date, next_ring):
-    schedule.set("progress", next_ring)
-    schedule.set("last_ring", remove_date_from_unixtime(time()))
-    if running[idx] is running[-1]:
-        log("completed schedule")
-        schedule.set("is_complete", True)
-        schedule.set("completed_on", current_time_with_date)
-        schedule.set("midnight_reset_count", 0)
-        active_schedules = schedule.get("active")
-        once = schedule.get("once")
-        i = 0
-        wild_schedules = schedule.get("wild_schedules")
-        weekly_schedules = schedule.get("weekly")
-        monthly_schedules = schedule.get("monthly")
-        weekly_and_monthly = [x for i in weekly_schedules for x in i]
-        monthly = [x for i in monthly_schedules for x in monthly_schedules[i]]
-        weekly_and_monthly.extend(monthly)
-        date = get_date()
-        while i < len(active_schedules):
-            if active_schedules[i] in wild_schedules:
-                schedules = schedule.get("schedules")
-                wild_schedule = schedules.get(active_schedules[i])
-                if wild_schedule[0][0] == "*": continue
-                r = range(len(wild_schedule)-1, 0, -1)
-                for j in r:
-                    gap = f"+{wild_schedule[j][0] - wild_schedule[j-1][0]}"
-                    wild_schedule[j][0] = gap
-                wild_schedule[0][0] = "*"
-                schedule.set("schedules", schedules)
-            if active_schedules[i] in (once.get(date) or []):
-                once[date].remove(active_schedules[i])
-                if once[date] == []: once.pop(date)
-                schedule.set("once", once)
-            if active_schedules[i] not in weekly_and_monthly:
-                active_schedules.pop(i)
-            else:
-                i += 1
-        schedule.set("active", active_schedules)
-        remove_non_existent_schedules()
+def save_progress(is_last, current_time_with_date, next_ring):
+    with state.batch(), schedule.batch():
+        state.set("progress", next_ring)
+        state.set("last_ring", remove_date_from_unixtime(time()))
+        if is_last:
+            log("completed schedule")
+            state.set("is_complete", True)
+            state.set("completed_on", current_time_with_date)
+            state.set("midnight_reset_count", 0)
+            active_schedules = schedule.get("active")
+            i = 0
+            triggers = schedule.get("triggers") or {}
+            date = get_date()
+            while i < len(active_schedules):
+                name = active_schedules[i]
+                if name in triggers:
+                    triggers.pop(name)
+                    schedule.set("triggers", triggers)
+                if date in references.lookup(name, "once"):
+                    references.unassign("once", date, [name])
+                if not references.lookup(name, "weekly") and not references.lookup(name, "monthly"):
+                    active_schedules.pop(i)
+                else:
+                    i += 1
+            schedule.set("active", active_schedules)
+            enforce_integrity()
 
 @micropython.native
 def reset_progress(current_time_with_date):
-    if schedule.get("progress") > remove_date_from_unixtime(current_time_with_date):
-        midnight_reset_count = schedule.get("midnight_reset_count")
-        schedule.set("midnight_reset_count", midnight_reset_count + 1)
-        schedule.set("progress", 0)
-        schedule.set("last_ring", config.get("gap") * -1)
-    if schedule.get("is_complete") and current_time_with_date - schedule.get("completed_on") > int(config.get("max_wait")):
-        log("reset schedule")
-        schedule.set("is_complete", False)
-        schedule.set("last_ring", config.get("gap") * -1)
-        schedule.set("progress", -1)
-        skip = schedule.get("skip")
-        date = get_date()
-        if date in skip: skip.pop(date)
-        schedule.set("skip", skip)
+    with state.batch():
+        if state.get("progress") > remove_date_from_unixtime(current_time_with_date):
+            midnight_reset_count = state.get("midnight_reset_count")
+            state.set("midnight_reset_count", midnight_reset_count + 1)
+            state.set("progress", 0)
+            state.set("last_ring", -settings.gap)
+        if state.get("is_complete") and current_time_with_date - state.get("completed_on") > settings.max_wait:
+            log("reset schedule")
+            state.set("is_complete", False)
+            state.set("last_ring", -settings.gap)
+            state.set("progress", -1)
+            references.clear("skip", get_date())
+
+async def wait_until(deadline):
+    seconds = deadline - time() - 1
+    if seconds > 0:
+        try:
+            await wait_for(schedule_changed.wait(), seconds)
+            return
+        except TimeoutError:
+            pass
+    while time() < deadline and not schedule_changed.is_set():
+        await sleep_ms(50)
 
 @micropython.native
 async def run():
     while True:
         try:
-            if not time_is_synced: await sleep(5)
-            await sleep(0.1)
+            schedule_changed.clear()
+            if not clock.is_synced:
+                await wait_until(time() + 5)
+                continue
             running = get_active_schedule()
 
             current_time_with_date = time()
             current_time = remove_date_from_unixtime(current_time_with_date)
 
             reset_progress(current_time_with_date)
+
+            max_wait = settings.max_wait
+            delay = 86400 - current_time
+            if state.get("is_complete"):
+                delay = min(delay, state.get("completed_on") + max_wait + 1 - current_time_with_date)
             
-            if running == []:
-                await sleep(1)
+            if len(running) == 0:
+                await wait_until(current_time_with_date + max(1, delay))
                 continue
             
-            progress = schedule.get("progress")
+            progress = state.get("progress")
             if progress >= 0: progress = remove_date_from_unixtime(progress)
 
-            idx = get_next_ring_index(running, progress, current_time)
-            next_ring = remove_date_from_unixtime(running[idx][0])
+            ring = running.next_ring(progress, current_time, state.get("midnight_reset_count"), max_wait)
+            if ring is None:
+                await wait_until(current_time_with_date + max(1, delay))
+                continue
+
+            next_ring, mode, is_last = ring
             has_rang = progress >= next_ring
+            is_due = current_time == next_ring or (0 < current_time - next_ring < max_wait) and not has_rang
+            ring_after = state.get("last_ring") + settings.gap + 1
             
-            if (current_time == next_ring or (0 < current_time - next_ring < int(config.get("max_wait"))) and not has_rang) and schedule.get("last_ring") + config.get("gap") < current_time:
-                params = running[idx][1]
-                log(running, params, idx)
-                ring_bell(params)
-                save_progress(running, idx, current_time_with_date, next_ring)
-#            elif current_time < next_ring:
-#                await sleep(next_ring - current_time)
-#            elif schedule.get("last_ring") + config.get("gap") >= current_time:
-#                await sleep(schedule.get("last_ring") + config.get("gap") - current_time)
-            else:
-                await sleep(1)
+            if is_due and ring_after <= current_time:
+                log(next_ring, mode)
+                await ring_bell(mode)
+                save_progress(is_last, current_time_with_date, next_ring)
+                continue
+
+            if current_time < next_ring:
+                delay = min(delay, next_ring - current_time)
+            elif is_due:
+                delay = min(delay, ring_after - current_time)
+            await wait_until(current_time_with_date + max(1, delay))
         except Exception as err:
             await sleep(0.1)
-            log(err, function_name = "schedule.run")
\ No newline at end of file
+            log(err, function_name = "schedule.run", level = ERROR)
\ No newline at end of file
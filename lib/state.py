@@ -0,0 +1,113 @@
+from struct import pack, unpack, calcsize
+from clock import rtc
+from config import settings
+
+STATE_MAGIC = 0xA0
+STATE_COMPLETE = 0x08
+STATE_SEQUENCE = 0x07
+STATE_FORMAT = "<BiiiB"
+STATE_FIELDS = ("progress", "last_ring", "is_complete", "completed_on", "midnight_reset_count")
+STATE_SIZE = calcsize(STATE_FORMAT) + 1
+STATE_SLOTS = 2
+
+def checksum(record):
+    return ~sum(record) & 0xFF
+
+def decode(record):
+    if len(record) != STATE_SIZE or record[0] & 0xF0 != STATE_MAGIC or checksum(record[:-1]) != record[-1]:
+        return None
+    header, progress, last_ring, completed_on, midnight_reset_count = unpack(STATE_FORMAT, record[:-1])
+    return header & STATE_SEQUENCE, {
+        "progress": progress,
+        "last_ring": last_ring,
+        "is_complete": bool(header & STATE_COMPLETE),
+        "completed_on": completed_on,
+        "midnight_reset_count": midnight_reset_count,
+        }
+
+class State:
+    def __init__(self):
+        self.depth = 0
+        self.is_dirty = False
+        self.slots = bytearray(self.read())
+        records = [decode(bytes(self.slots[i * STATE_SIZE:(i + 1) * STATE_SIZE])) for i in range(STATE_SLOTS)]
+        self.slot = 1
+        if records[0] and records[1]:
+            self.slot = 1 if (records[1][0] - records[0][0]) & STATE_SEQUENCE == 1 else 0
+        elif records[0]:
+            self.slot = 0
+        record = records[self.slot]
+        self.is_valid = bool(record)
+        self.sequence = record[0] if record else 0
+        self.record = bytes(self.slots[self.slot * STATE_SIZE:(self.slot + 1) * STATE_SIZE]) if record else None
+        if record:
+            self.values = record[1]
+        else:
+            self.values = {
+                "progress": -1,
+                "last_ring": -settings.gap,
+                "is_complete": False,
+                "completed_on": 0,
+                "midnight_reset_count": 0,
+                }
+
+    def read(self):
+        return bytes(rtc.ram_burst(count=STATE_SIZE * STATE_SLOTS))
+
+    def write(self, slots):
+        rtc.ram_burst(slots)
+
+    def encode(self, sequence):
+        values = self.values
+        header = STATE_MAGIC | (STATE_COMPLETE if values["is_complete"] else 0) | sequence & STATE_SEQUENCE
+        record = pack(STATE_FORMAT, header, values["progress"], values["last_ring"],
+            values["completed_on"], min(values["midnight_reset_count"], 255))
+        return record + bytes([checksum(record)])
+
+    def save(self):
+        if self.encode(self.sequence) == self.record: return True
+        sequence = (self.sequence + 1) & STATE_SEQUENCE
+        slot = 1 - self.slot
+        record = self.encode(sequence)
+        slots = bytearray(self.slots)
+        slots[slot * STATE_SIZE:(slot + 1) * STATE_SIZE] = record
+        try:
+            self.write(bytes(slots))
+            self.slots = slots
+            self.slot = slot
+            self.sequence = sequence
+            self.record = record
+            self.is_valid = True
+            return True
+        except:
+            return False
+
+    def load(self):
+        return self.values
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+        if self.depth > 0:
+            self.is_dirty = True
+            return value
+        if self.save():
+            return value
+
+    def batch(self):
+        return self
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.depth -= 1
+        if self.depth > 0 or not self.is_dirty: return
+        self.is_dirty = False
+        self.save()
+
+
+state = State()
@@ -1,8 +1,9 @@
 from machine import Pin
-from utime import sleep
+from asyncio import sleep, create_task, CancelledError
 
 relay = Pin(22, Pin.OUT, value=1)
 led = Pin("LED", Pin.OUT)
+ringing = None
 
 def switch_on():
     led.on()
@@ -12,12 +13,32 @@ def switch_off():
     led.off()
     relay.value(1)
 
-def timer(seconds):
-    switch_on()
-    sleep(seconds)
+def is_ringing():
+    return ringing is not None and not ringing.done()
+
+def stop():
+    global ringing
+    if ringing is not None:
+        ringing.cancel()
+        ringing = None
     switch_off()
-    
-def repeat_timer(count, timer_seconds, sleep_seconds):
-    for _ in range(count):
-        timer(timer_seconds)
-        sleep(sleep_seconds)
\ No newline at end of file
+
+async def pulse(count, on_seconds, off_seconds):
+    for i in range(count):
+        switch_on()
+        await sleep(on_seconds)
+        switch_off()
+        if i < count - 1: await sleep(off_seconds)
+
+async def ring(count, on_seconds, off_seconds=0):
+    global ringing
+    stop()
+    task = create_task(pulse(count, on_seconds, off_seconds))
+    ringing = task
+    try:
+        await task
+        return True
+    except CancelledError:
+        return False
+    finally:
+        if ringing is task: ringing = None
\ No newline at end of file
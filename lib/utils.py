@@ -1,4 +1,4 @@
-from log import log
+from log import log, flush, WARNING, ERROR
 
 @micropython.native
 def try_till_success(function, err_msg="", max_try = -1, should_reset = False):
@@ -11,19 +11,20 @@ def try_till_success(function, err_msg="", max_try = -1, should_reset = False):
         try:
             return function()
         except TypeError as err:
-            log(err)
+            log(err, level = ERROR)
             return
         except OSError as err:
             collect()
-            log(err, err_msg)
+            log(err, err_msg, level = WARNING)
         except Exception as err:
-            log(err, err_msg)
+            log(err, err_msg, level = WARNING)
             continue
         else:
             return
     
     if should_reset:
         from machine import reset
+        flush()
         reset()
 
 def bind(function, *args, **kwargs):
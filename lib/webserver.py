@@ -1,14 +1,42 @@
-from asyncio import sleep
+from asyncio import sleep, create_task
 from microdot import Microdot, redirect
 from microdot.cors import CORS
-from schedule import schedule, all_schedule_exists, ring_bell, is_wild_schedule
-from config import JSON, config
-from clock import get_date
-from log import log
+from schedule import schedule, references, enforce_integrity, all_schedule_exists, ring_bell, parse_mode, is_wild_schedule, normalize_schedule, normalize_skip_range, merge_skip_ranges, parse_date, format_date
+from error import InvalidSchedule, InvalidPatch, StoreChanged
+from switch import is_ringing
+from state import state
+from config import JSON, config, SETTINGS, iterchunks, parse_pointer
+from clock import get_date, get_drift
+from log import log, flush, read_log, format_time, ERROR
+
+LOG_PAGE_SIZE = 100
 
 app = Microdot()
 env = JSON("/.env.json")
-cors = CORS(app, allowed_origins="*", allow_credentials=True)
+cors = CORS(app, allowed_origins="*", allow_credentials=True, expose_headers=["ETag"])
+
+def cached_response(request, store):
+    version, etag = store.version, store.etag
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+
+    def body():
+        if store.version != version: raise StoreChanged(store.file)
+        yield b'{"success": true, "data": '
+        yield from store.stream()
+        yield b'}'
+
+    return body(), 200, {"Content-Type": "application/json", "ETag": etag}
+
+def stream_chunks(chunks, store):
+    version = store.version
+    for chunk in chunks:
+        yield chunk
+        if store.version != version: raise StoreChanged(store.file)
+
+def streamed_response(data, store, status=200):
+    chunks = iterchunks({"success": True, "data": data})
+    return stream_chunks(chunks, store), status, {"Content-Type": "application/json"}
 
 @app.before_request
 async def authenticate(request):
@@ -33,11 +61,7 @@ async def verify(request):
 async def get_schedule(request):
     args = request.args
     
-    if not args:
-        return {
-            "success": True,
-            "data": schedule.load(),
-            }, 200
+    if not args: return cached_response(request, schedule)
     
     keys = args.getlist("key")
     values = {}
@@ -52,20 +76,51 @@ async def get_schedule(request):
             "msg": "Key doesn't exist"
             }
     
+    return streamed_response(values, schedule)
+
+@app.get("/schedule/state")
+async def get_schedule_state(request):
     return {
         "success": True,
-        "data": values,
+        "data": state.load(),
         }, 200
 
+@app.get("/log")
+async def get_log(request):
+    args = request.args
+    try:
+        offset = int(args.get("offset", 0))
+        limit = int(args.get("limit", LOG_PAGE_SIZE))
+        tail = args.get("tail")
+        tail = None if tail is None else int(tail)
+        since = args.get("since")
+        since = None if since is None else int(since)
+        reverse = args.get("order", "asc") == "desc"
+    except ValueError:
+        return {
+            "success": False,
+            "msg": "Invalid parameters",
+            }, 422
+
+    if offset < 0 or limit < 0 or tail is not None and tail < 0:
+        return {
+            "success": False,
+            "msg": "Invalid parameters",
+            }, 422
+
+    flush()
+
+    def lines():
+        for unixtime, text in read_log(offset, limit, tail, since, reverse):
+            yield f"[{format_time(unixtime)}] {text}\n"
+
+    return lines(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 @app.get("/config")
 async def get_config(request):
     args = request.args
     
-    if not args:
-        return {
-            "success": True,
-            "data": config.load(),
-            }, 200
+    if not args: return cached_response(request, config)
     
     keys = args.getlist("key")
     values = {}
@@ -85,6 +140,13 @@ async def get_config(request):
         "data": values,
         }
 
+@app.get("/clock")
+async def get_clock(request):
+    return {
+        "success": True,
+        "data": get_drift(),
+        }, 200
+
 @app.put("/schedule/active")
 async def set_active_schedule(request):
     active = (request.json or {}).get("active")
@@ -115,21 +177,40 @@ async def set_active_schedule(request):
 
 @app.put("/schedule/skip")
 async def set_active_schedule(request):
-    skip_update = (request.json or {}).get("skip")
-    if not skip_update:
+    skip_update = (request.json or {}).get("skip") or {}
+    ranges_update = (request.json or {}).get("ranges")
+    if not skip_update and ranges_update is None:
         return {
             "success": False,
             "msg": "Missing parameters",
             }, 404
 
-    skip = schedule.get("skip")
-    skip.update(skip_update)
-    schedule.set("skip", skip)
+    if ranges_update is not None:
+        try:
+            if type(ranges_update) != list: raise InvalidSchedule("Skip ranges must be a list")
+            ranges_update = [normalize_skip_range(i) for i in ranges_update]
+        except InvalidSchedule as err:
+            return {
+                "success": False,
+                "msg": str(err),
+                }, 422
+        if not all_schedule_exists(*[j for i in ranges_update for j in i["schedules"]]):
+            return {
+                "success": False,
+                "msg": "Schedule doesn't exist",
+                }, 404
+
+    with schedule.batch():
+        for date in skip_update:
+            references.replace("skip", date, skip_update[date] or [])
+        if ranges_update is not None:
+            schedule.set("skip_ranges", merge_skip_ranges(schedule.get("skip_ranges") or [], ranges_update))
     
     return {
         "success": True,
         "data": {
-            "skip": skip,
+            "skip": schedule.get("skip"),
+            "ranges": schedule.get("skip_ranges") or [],
             },
         }, 201
 
@@ -155,84 +236,61 @@ async def set_schedule(request):
             "msg": "No schedules given to add/update",
             }, 422
 
-    added = {}
     if not is_assign_only:
-        schedules = schedule.get("schedules")
-        for key in schedules_update:
-            if request.method == "POST" and schedules.get(key):
-                continue
-            schedules[key] = schedules_update[key]
-            added[key] = schedules_update[key]
-
-            wild_schedules = schedule.get("wild_schedules")
-            if is_wild_schedule(key) and key not in wild_schedules: 
-                wild_schedules.append(key)
-                schedule.set("wild_schedules", wild_schedules)
+        if type(schedules_update) != dict:
+            return {
+                "success": False,
+                "msg": "Schedules must be an object",
+                }, 422
+        try:
+            schedules_update = {key: normalize_schedule(key, schedules_update[key]) for key in schedules_update}
+        except InvalidSchedule as err:
+            return {
+                "success": False,
+                "msg": str(err),
+                }, 422
+
+    added = {}
+    with schedule.batch():
+        if not is_assign_only:
+            schedules = schedule.get("schedules")
+            for key in schedules_update:
+                if request.method == "POST" and schedules.get(key):
+                    continue
+                schedules[key] = schedules_update[key]
+                added[key] = schedules_update[key]
+
+                wild_schedules = schedule.get("wild_schedules")
+                if is_wild_schedule(key) and key not in wild_schedules: 
+                    wild_schedules.append(key)
+                    schedule.set("wild_schedules", wild_schedules)
                 
-        schedule.set("schedules", schedules)
+            schedule.set("schedules", schedules)
 
-    if remove_existing:
-        once = schedule.get("once")
-        weekly_schedules = schedule.get("weekly")
-        monthly_schedules = schedule.get("monthly")
-        schedules_to_remove = set()
+        if remove_existing:
+            schedules_to_remove = set()
         
-        for i in weekly_schedules_update:
-            schedules_to_remove.update(weekly_schedules_update[i])
-
-        for i in monthly_schedules_update:
-            schedules_to_remove.update(monthly_schedules_update[i])
-
-        for i in once_update:
-            schedules_to_remove.update(once_update[i])
-
-        for day_schedules in weekly_schedules:
-            for i in schedules_to_remove:
-                if i in day_schedules:
-                    day_schedules.remove(i)
-
-        for i in list(monthly_schedules.keys()):
-            for j in schedules_to_remove:
-                if j in monthly_schedules[i]:
-                    monthly_schedules[i].remove(j)
-            if not monthly_schedules[i]: monthly_schedules.pop(i)
-
-        for i in list(once.keys()):
-            for j in schedules_to_remove:
-                if j in once[i]:
-                    once[i].remove(j)
-            if not once[i]: once.pop(i)
-
-    if weekly_schedules_update:
-        weekly_schedules = schedule.get("weekly")
+            for i in weekly_schedules_update:
+                schedules_to_remove.update(weekly_schedules_update[i])
+
+            for i in monthly_schedules_update:
+                schedules_to_remove.update(monthly_schedules_update[i])
+
+            for i in once_update:
+                schedules_to_remove.update(once_update[i])
+
+            references.unassign_all(schedules_to_remove, ("weekly", "monthly", "once"))
+
         for i, schedule_list in weekly_schedules_update.items():
             idx = int(i)
-            if 0 <= idx <= 6:
-                weekly_schedules[idx].extend(schedule_list)
-                weekly_schedules[idx] = list(set(weekly_schedules[idx]))
-        schedule.set("weekly", weekly_schedules)
+            if 0 <= idx <= 6: references.assign("weekly", idx, schedule_list)
 
-    if monthly_schedules_update:
-        monthly_schedules = schedule.get("monthly")
         for i, schedule_list in monthly_schedules_update.items():
             idx = int(i)
-            if not (1 <= idx <= 31): continue
-            if i in monthly_schedules:
-                monthly_schedules[i].extend(schedule_list)
-                monthly_schedules[i] = list(set(monthly_schedules[i]))
-            else:
-                monthly_schedules[i] = list(set(schedule_list))
-        schedule.set("monthly", monthly_schedules)
-
-    if once_update:
-        once = schedule.get("once")
-        for i in once_update:
-            if i not in once:
-                once[i] = once_update[i] or []
-                continue
-            once[i].extend(once_update[i])
-            once[i] = list(set(once[i]))
-        schedule.set("once", once)
+            if 1 <= idx <= 31: references.assign("monthly", str(idx), schedule_list)
+
+        for i, schedule_list in once_update.items():
+            references.assign("once", i, schedule_list or [])
 
     return {
         "success": True,
@@ -252,49 +310,253 @@ async def delete_schedule(request):
 
     schedules = schedule.get("schedules")
     deleted = {}
-    active = schedule.get("active")
-    weekly_schedules = schedule.get("weekly")
-    monthly_schedules = schedule.get("monthly")
-    once = schedule.get("once")
-    skip = schedule.get("skip")
-    wild_schedules = schedule.get("wild_schedules")
-
-    for key in schedules_to_delete:
-        if key in active and not force or key not in schedules: continue
-        if key in wild_schedules: wild_schedules.remove(key)
-        
-        if key in active:
-            active.remove(key)
-            
-        for date in list(once.keys()):
-            if key in once[date]:
-                once[date].remove(key)
-            if not once[date]: once.pop(date)
-
-        for date in list(skip.keys()):
-            if key in skip[date]:
-                skip[date].remove(key)
-            if not skip[date]: skip.pop(date)
-        
-        for weekly_schedule in weekly_schedules:
-            if key in weekly_schedule:
-                weekly_schedule.remove(key)
-
-        for date in list(monthly_schedules.keys()):
-            if key in monthly_schedules[date]:
-                monthly_schedules[date].remove(key)
-            if not monthly_schedules[date]: monthly_schedules.pop(date)
-
-        deleted[key] = schedules.pop(key)
-    schedule.set("schedules", schedules)
-    schedule.set("once", once)
-    schedule.set("monthly", monthly_schedules)
-    schedule.set("weekly", weekly_schedules)
+    active = set(schedule.get("active"))
+
+    with schedule.batch():
+        for key in schedules_to_delete:
+            if key in active and not force or key not in schedules: continue
+            deleted[key] = schedules.pop(key)
+        schedule.set("schedules", schedules)
+        enforce_integrity(dict.fromkeys(deleted))
     return {
         "success": True,
         "data": deleted,
         }, 200
 
+@app.post("/schedule/maintenance")
+async def schedule_maintenance(request):
+    renamed = (request.json or {}).get("rename") or {}
+    schedules = schedule.get("schedules")
+
+    if type(renamed) != dict or not all(type(i) == str and i for i in renamed.values()) or len(set(renamed.values())) != len(renamed):
+        return {
+            "success": False,
+            "msg": "Rename must map each schedule to a unique new name",
+            }, 422
+
+    for old_name, new_name in renamed.items():
+        if old_name not in schedules:
+            return {
+                "success": False,
+                "msg": f"Schedule '{old_name}' doesn't exist",
+                }, 404
+        if new_name in schedules:
+            return {
+                "success": False,
+                "msg": f"Can't rename '{old_name}' to '{new_name}'",
+                }, 422
+
+    with schedule.batch():
+        moved = {old_name: schedules.pop(old_name) for old_name in renamed}
+        for old_name, new_name in renamed.items():
+            schedules[new_name] = moved[old_name]
+        schedule.set("schedules", schedules)
+        changed = enforce_integrity(renamed)
+    return {
+        "success": True,
+        "data": {
+            "renamed": renamed,
+            "updated": sorted(changed),
+            },
+        }, 200
+
+def unique_names(names):
+    if type(names) != list or not all(type(i) == str for i in names):
+        raise InvalidSchedule("Names must be a list of strings")
+    return list(dict.fromkeys(names))
+
+def check_names(names, existing):
+    for name in names:
+        if name not in existing: raise InvalidSchedule(f"Schedule '{name}' doesn't exist")
+
+def validate_operation(operation, existing, active):
+    if type(operation) != dict: raise InvalidSchedule("Operation must be an object")
+    op = operation.get("op")
+    if op == "upsert":
+        name = operation.get("name")
+        if type(name) != str or not name: raise InvalidSchedule("Upsert needs a name")
+        existing.add(name)
+        return {"op": op, "name": name, "schedule": normalize_schedule(name, operation.get("schedule"))}
+    if op == "assign":
+        kind = operation.get("kind")
+        key = operation.get("key")
+        names = unique_names(operation.get("names"))
+        try:
+            if kind == "weekly": key = int(key)
+            elif kind == "monthly": key = str(int(key))
+            elif kind == "once": key = format_date(parse_date(key))
+            else: raise InvalidSchedule(f"Invalid kind '{kind}'")
+        except (TypeError, ValueError):
+            raise InvalidSchedule(f"Invalid {kind} key '{key}'")
+        if kind == "weekly" and not 0 <= key <= 6 or kind == "monthly" and not 1 <= int(key) <= 31:
+            raise InvalidSchedule(f"Invalid {kind} key '{key}'")
+        check_names(names, existing)
+        return {"op": op, "kind": kind, "key": key, "names": names, "replace": bool(operation.get("replace"))}
+    if op == "activate":
+        names = operation.get("names")
+        check_names(unique_names(names), existing)
+        names = list(dict.fromkeys(names[::-1]))[::-1]
+        active.clear()
+        active.update(names)
+        return {"op": op, "names": names}
+    if op == "skip":
+        if operation.get("range") is not None:
+            skip_range = normalize_skip_range(operation.get("range"))
+            check_names(skip_range["schedules"], existing)
+            return {"op": op, "range": skip_range}
+        names = unique_names(operation.get("names"))
+        check_names(names, existing)
+        return {"op": op, "date": format_date(parse_date(operation.get("date"))), "names": names}
+    if op == "delete":
+        names = unique_names(operation.get("names"))
+        check_names(names, existing)
+        if not operation.get("force"):
+            for name in names:
+                if name in active: raise InvalidSchedule(f"Schedule '{name}' is active")
+        existing.difference_update(names)
+        active.difference_update(names)
+        return {"op": op, "names": names}
+    raise InvalidSchedule(f"Unknown operation '{op}'")
+
+def apply_operation(operation):
+    op = operation["op"]
+    if op == "upsert":
+        name = operation["name"]
+        schedules = schedule.get("schedules")
+        schedules[name] = operation["schedule"]
+        schedule.set("schedules", schedules)
+        wild_schedules = schedule.get("wild_schedules")
+        if is_wild_schedule(name) and name not in wild_schedules:
+            wild_schedules.append(name)
+            schedule.set("wild_schedules", wild_schedules)
+        return {name: operation["schedule"]}
+    if op == "assign":
+        kind, key, names = operation["kind"], operation["key"], operation["names"]
+        if operation["replace"]: references.replace(kind, key, names)
+        else: references.assign(kind, key, names)
+        return {"key": key, "names": list(references.reference_list(kind, key) or [])}
+    if op == "activate":
+        schedule.set("active", operation["names"])
+        return {"active": operation["names"]}
+    if op == "skip":
+        if "range" in operation:
+            schedule.set("skip_ranges", merge_skip_ranges(schedule.get("skip_ranges") or [], [operation["range"]]))
+            return {"range": operation["range"]}
+        references.replace("skip", operation["date"], operation["names"])
+        return {"date": operation["date"], "names": operation["names"]}
+    if op == "delete":
+        schedules = schedule.get("schedules")
+        deleted = {name: schedules.pop(name) for name in operation["names"]}
+        schedule.set("schedules", schedules)
+        enforce_integrity(dict.fromkeys(deleted))
+        return deleted
+
+@app.post("/schedule/batch")
+async def batch_schedule(request):
+    operations = (request.json or {}).get("operations")
+    if type(operations) != list or not operations:
+        return {
+            "success": False,
+            "msg": "No operations given",
+            }, 422
+
+    existing = set(schedule.get("schedules"))
+    active = set(schedule.get("active"))
+    validated = []
+    for i, operation in enumerate(operations):
+        try:
+            validated.append(validate_operation(operation, existing, active))
+        except InvalidSchedule as err:
+            return {
+                "success": False,
+                "msg": f"Operation {i}: {err}",
+                "index": i,
+                }, 422
+
+    results = []
+    with schedule.batch():
+        for operation in validated:
+            results.append({
+                "op": operation["op"],
+                "success": True,
+                "data": apply_operation(operation),
+                })
+    return streamed_response(results, schedule)
+
+REFERENCE_KEYS = ("active", "wild_schedules", "weekly", "monthly", "once", "skip", "skip_ranges", "triggers")
+
+def patched_schedules(operations):
+    names = set()
+    for operation in operations:
+        for pointer in (operation.get("path"), operation.get("from")):
+            if pointer is None or operation.get("op") == "test": continue
+            tokens = parse_pointer(pointer)
+            if tokens[:1] != ["schedules"]: continue
+            if len(tokens) == 1: return set(schedule.get("schedules"))
+            names.add(tokens[1])
+    return names
+
+def check_patched_schedule(touched, operations):
+    schedules = schedule.get("schedules")
+    if "schedules" in touched:
+        for name in patched_schedules(operations):
+            if name in schedules: schedules[name] = normalize_schedule(name, schedules[name])
+        schedule.set("schedules", schedules)
+        wild_schedules = [i for i in schedule.get("wild_schedules") if i in schedules and is_wild_schedule(i)]
+        wild_schedules += [i for i in schedules if is_wild_schedule(i) and i not in wild_schedules]
+        schedule.set("wild_schedules", wild_schedules)
+        enforce_integrity()
+    elif touched.intersection(REFERENCE_KEYS):
+        dangling = [i for i in references.names() + schedule.get("active") if i not in schedules]
+        if dangling: raise InvalidSchedule(f"Schedule '{dangling[0]}' doesn't exist")
+
+def check_patched_config(touched, operations):
+    for key in touched:
+        if key not in SETTINGS: continue
+        try:
+            SETTINGS[key][0](config.get(key))
+        except (TypeError, ValueError):
+            raise InvalidPatch(f"Invalid value for '{key}'")
+
+def patch_store(request, store, check):
+    etag = request.headers.get("If-Match")
+    if etag is not None and etag != "*" and etag != store.etag:
+        return {
+            "success": False,
+            "msg": "Document has changed",
+            }, 412, {"ETag": store.etag}
+
+    operations = request.json
+    if type(operations) == dict: operations = operations.get("patch")
+    try:
+        with store.batch():
+            types = {key: type(value) for key, value in store.load().items()}
+            touched = store.patch(operations)
+            for key in touched:
+                if key in types and type(store.get(key)) != types[key]:
+                    raise InvalidPatch(f"Can't change the type of '{key}'")
+            check(touched, operations)
+    except (InvalidPatch, InvalidSchedule) as err:
+        return {
+            "success": False,
+            "msg": str(err),
+            }, 422, {"ETag": store.etag}
+
+    return {
+        "success": True,
+        "data": {
+            "updated": sorted(touched),
+            },
+        }, 200, {"ETag": store.etag}
+
+@app.patch("/schedule")
+async def patch_schedule(request):
+    return patch_store(request, schedule, check_patched_schedule)
+
+@app.patch("/config")
+async def patch_config(request):
+    return patch_store(request, config, check_patched_config)
+
 @app.post("/signin")
 async def signin(request):
     from urequests import delete
@@ -335,11 +597,22 @@ async def set_config(request):
             "msg": "Missing parameters",
             }, 422
 
+    for key, value in new_config.items():
+        if key not in SETTINGS: continue
+        try:
+            SETTINGS[key][0](value)
+        except (TypeError, ValueError):
+            return {
+                "success": False,
+                "msg": f"Invalid value for '{key}'",
+                }, 422
+
     updated = {}
-    for key in new_config:
-        if config.get(key) is None: continue
-        config.set(key, new_config.get(key))
-        updated[key] = new_config.get(key)
+    with config.batch():
+        for key in new_config:
+            if config.get(key) is None and key not in SETTINGS: continue
+            config.set(key, new_config.get(key))
+            updated[key] = new_config.get(key)
     
     if not updated:
         return {
@@ -379,16 +652,27 @@ async def reset_password(request):
 @app.post("/bell/ring")
 async def manual_ring(request):
     mode = (request.json or {}).get("mode")
-    if not mode:
+    try:
+        mode = parse_mode(mode)
+    except (AttributeError, IndexError, ValueError):
         return {
             "success": False,
             "msg": "Couldn't ring bell"
             }
-    ring_bell(mode)
+    create_task(ring_bell(mode))
     return {
         "success": True,
         }, 201
 
+@app.get("/bell")
+async def bell_status(request):
+    return {
+        "success": True,
+        "data": {
+            "ringing": is_ringing(),
+            },
+        }
+
 @app.post("/signup")
 async def signup(request):
     from gc import  collect
@@ -460,28 +744,16 @@ async def run_schedule(request):
             "msg": "Schedule doesn't exist",
             }, 404
     
-    if is_wild_schedule(schedule_name):
-        wild_schedule = schedules.get(schedule_name)
-
-        prev_time = time()
-        wild_schedule[0][0] = prev_time
-        r = range(1, len(wild_schedule))
-        for i in r:
-            gap = int(wild_schedule[i][0][1:])
-            prev_time += gap
-            wild_schedule[i][0] = prev_time
-        schedule.set("schedules", schedules)
-
-    active_schedules = schedule.get("active")
-    if active_schedules == [] or active_schedules[-1] != schedule_name: active_schedules.append(schedule_name)
-    once = schedule.get("once")
-    date = get_date()
-    once_schedule_list = once.get(date)
-    if not once_schedule_list: [schedule_name]
-    else: once_schedule_list.append(schedule_name)
-    once[date] = once_schedule_list
-    schedule.set("once", once)
-    schedule.set("active", active_schedules)
+    with schedule.batch():
+        if is_wild_schedule(schedule_name):
+            triggers = schedule.get("triggers") or {}
+            triggers[schedule_name] = time()
+            schedule.set("triggers", triggers)
+
+        active_schedules = schedule.get("active")
+        if active_schedules == [] or active_schedules[-1] != schedule_name: active_schedules.append(schedule_name)
+        references.assign("once", get_date(), [schedule_name])
+        schedule.set("active", active_schedules)
     await sleep(0.5)
     return {
         "success": True,
@@ -518,7 +790,8 @@ def os_error(request, exception):
     from gc import collect
     from machine import reset
     collect()
-    log(exception)
+    log(exception, level = ERROR)
+    flush()
     reset()
     return {
         "success": False,
@@ -527,7 +800,7 @@ def os_error(request, exception):
 
 @app.errorhandler(RuntimeError)
 def runtime_error(request, exception):
-    log(exception)
+    log(exception, level = ERROR)
     return {
         "success": False,
         "msg": "Runtime error",
@@ -535,7 +808,7 @@ def runtime_error(request, exception):
 
 @app.errorhandler(Exception)
 def unkown_error(request, exception):
-    log(exception)
+    log(exception, level = ERROR)
     return {
         "success": False,
         "msg": "Unkown error",
@@ -1,6 +1,6 @@
 from network import WLAN, STA_IF
 from config import config
-from log import log
+from log import log, flush, WARNING
 
 wlan = WLAN(STA_IF)
 wlan.config(pm=WLAN.PM_NONE)
@@ -39,24 +39,25 @@ def connect(ssid, password):
         if status == STAT_GOT_IP:
             break
         elif status == STAT_NO_AP_FOUND:
-            log("No access point found")
+            log("No access point found", level = WARNING)
             no_ap_retry -= 1
             if no_ap_retry < 0:
                 raise NoAccessPointFound()
         elif status == STAT_WRONG_PASSWORD or max_wait == 1:
             wlan.disconnect()
-            log("Wrong Password")
+            log("Wrong Password", level = WARNING)
             raise WrongPassword()
         elif status == STAT_CONNECT_FAIL:
             raise ConnectionFailed()
         elif status == 0:
             from machine import reset
+            flush()
             reset()
 
         print(f"SSID: {ssid}, Password: {password}, status:", status)
         max_wait -= 1
         sleep(0.2)
-    log(f"Connection IP: {get_ip()}")
+    log("Connection IP:", get_ip())
     pico_led.off()
     return get_ip()
     
@@ -78,10 +79,10 @@ def scan_and_connect():
             ssid = wlan_info[0]
             password = env.get("key")
             ip = connect(ssid, password)
-            log(f"Connection IP: {ip}")
+            log("Connection IP:", ip)
             return ssid, password, ip
         except ConnectionFailed:
-            log("Connection failed")
+            log("Connection failed", level = WARNING)
         except (NoAccessPointFound, WrongPassword):
             continue   
 
@@ -94,22 +95,23 @@ def connect_to_wlan():
         for wlan_cred in wlan_credentials:
             if wlan.isconnected():
               ip = get_ip()
-              log(f"Connection IP: {ip}")
+              log("Connection IP:", ip)
               return config.set("ip", ip)
 
             try:
               ssid = wlan_cred.get("ssid")
               password = wlan_cred.get("password")
               ip = connect(ssid, password)
-              log(f"Connection IP: {ip}")
+              log("Connection IP:", ip)
               return config.set("ip", ip)
             except (NoAccessPointFound, WrongPassword):
                 continue
 
     ssid, password, ip = scan_and_connect()
-    config.set("wlan_credentials", [{ "ssid": ssid, "password": password}])
-    log(f"Connection IP: {ip}")
-    return config.set("ip", ip)
+    log("Connection IP:", ip)
+    with config.batch():
+        config.set("wlan_credentials", [{ "ssid": ssid, "password": password}])
+        return config.set("ip", ip)
 
 def register_ip():
     from config import JSON
@@ -129,11 +131,12 @@ def register_ip():
             })
         res = post(f"{config.get('backend_api')}/device", headers=header, data=payload).json()
         if res.get("success"):
-            env.set("ip", ip)
-            device_id = env.set("device_id", res["data"].get("deviceId"))
+            with env.batch():
+                env.set("ip", ip)
+                device_id = env.set("device_id", res["data"].get("deviceId"))
             log("Device registered on database with id", device_id)
             return device_id
-        log("Couldn't register device")
+        log("Couldn't register device", level = WARNING)
         raise Exception("Device not registered", str(res))
     if ip != env.get("ip"):
         from urequests import put
@@ -147,7 +150,7 @@ def register_ip():
         if res.get("success"):
             log("IP changed on database", ip)
             return env.set("ip", ip)
-        log("Couldn't update IP on database")
+        log("Couldn't update IP on database", level = WARNING)
         raise Exception("Couldn't update IP on database")
         
         